@@ -1,9 +1,10 @@
 """
 Script per aggiornamento layer GeoPackage - QGIS Processing Toolbox
-Versione pragmatica che usa solo l'API di QGIS (no SQL diretto)
+Versione pragmatica che usa l'API di QGIS per leggere e scrivere i dati;
+le funzioni SQL di GDAL servono solo per l'indice spaziale
 """
 
-from qgis.PyQt.QtCore import QCoreApplication
+from qgis.PyQt.QtCore import QCoreApplication, QVariant
 from qgis.core import (QgsProcessing,
                        QgsFeatureSink,
                        QgsProcessingException,
@@ -15,18 +16,68 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingParameterFile,
                        QgsProcessingOutputString,
                        QgsVectorLayer,
+                       QgsVectorLayerFeatureSource,
                        QgsFeature,
                        QgsField,
                        QgsFields,
                        QgsWkbTypes,
                        QgsCoordinateReferenceSystem,
                        QgsFeatureRequest,
+                       QgsExpression,
                        QgsVectorFileWriter,
-                       QgsProject)
+                       QgsProject,
+                       QgsProviderRegistry,
+                       QgsTransaction)
 from qgis import processing
+from osgeo import gdal, ogr
 import os
 import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from operator import itemgetter
+
+try:
+    import reflink
+except ImportError:
+    reflink = None
+
+# L'indice spaziale RTree viene rimosso prima dell'aggiornamento e ricostruito
+# in blocco alla fine solo se i record scritti sono almeno questo numero e
+# almeno questa frazione del layer: su layer molto grandi ricostruire l'intero
+# indice costa più degli aggiornamenti riga per riga dei trigger
+SPATIAL_INDEX_REBUILD_MIN_WRITES = 10000
+SPATIAL_INDEX_REBUILD_RATIO = 0.2
+
+# Numero di fid richiesti al provider per ogni lettura a blocchi
+FID_BATCH_SIZE = 1000
+
+# Numero massimo di record utente per cui le chiavi si cercano direttamente
+# nel layer condiviso con un filtro IN invece di leggerne tutta la colonna chiave
+KEY_LOOKUP_MAX_USER_FEATURES = 1000
+
+# Numero minimo di record utente (o conteggio sconosciuto) per cui si fondono
+# le due letture ordinate per chiave: sotto questa soglia tenere in memoria i
+# record utente e l'indice chiave -> fid costa meno dei due ordinamenti
+MERGE_JOIN_MIN_USER_FEATURES = 100000
+
+# PRAGMA SQLite impostati sulla connessione del provider, prima di aprire la
+# transazione di scrittura: niente fsync, cache di 512 MB, temporanei in memoria.
+# La durabilità ridotta è coperta dal backup creato prima di scrivere.
+# Il journal_mode non si cambia: con altre connessioni aperte sul file
+# (es. il disegno della mappa) il cambio può fallire o restare sul file
+BULK_WRITE_PRAGMAS = {
+    'synchronous': 'OFF',
+    'cache_size': '-524288',
+    'temp_store': 'MEMORY',
+}
+
+
+class UnsortedKeysError(Exception):
+    """
+    Le chiavi lette dal provider non sono nell'ordine richiesto dal confronto per fusione
+    """
 
 
 class GeoPackageUpdaterAlgorithm(QgsProcessingAlgorithm):
@@ -62,7 +113,8 @@ class GeoPackageUpdaterAlgorithm(QgsProcessingAlgorithm):
 
     def shortHelpString(self):
         return self.tr("""
-Versione semplificata che usa solo l'API di QGIS, no SQL diretto.
+Versione semplificata che legge e scrive i dati con l'API di QGIS;
+l'indice spaziale viene gestito con le funzioni SQL di GDAL.
 
 Parametri:
 - Layer Condiviso: Il layer del GeoPackage condiviso da aggiornare
@@ -71,6 +123,9 @@ Parametri:
 - Solo Anteprima: Se selezionato, mostra solo le differenze senza aggiornare
 
 Crea automaticamente un backup prima dell'aggiornamento.
+Per aggiornamenti molto grandi l'indice spaziale viene ricostruito al termine:
+durante l'aggiornamento le altre connessioni al file (es. il disegno della
+mappa dello stesso GeoPackage) non trovano l'indice spaziale.
         """)
 
     def initAlgorithm(self, config=None):
@@ -165,50 +220,148 @@ Crea automaticamente un backup prima dell'aggiornamento.
 
     def analyze_differences(self, shared_layer, user_layer, key_field, feedback):
         """
-        Analizza le differenze tra i due layer (questa parte funziona già)
+        Analizza le differenze tra i due layer e restituisce (nuovi record, record modificati, rapporto).
+        La strategia dipende dal numero di record utente e dal tipo della chiave:
+        - fino a KEY_LOOKUP_MAX_USER_FEATURES: le chiavi utente si cercano nel layer
+          condiviso con un filtro IN (più IS NULL per la chiave NULL);
+        - oltre MERGE_JOIN_MIN_USER_FEATURES (o con conteggio sconosciuto) e chiavi dello
+          stesso tipo: fusione delle letture ordinate per chiave (merge_differences); se il
+          provider non restituisce le chiavi in ordine (UnsortedKeysError) si ripiega
+          sull'indice in memoria;
+        - altrimenti: indice in memoria chiave -> fid del layer condiviso, letto in
+          parallelo ai record utente.
+        In tutti i casi i record in comune si leggono per fid a blocchi (compare_pairs)
+        e si confrontano con check_modified
         """
         feedback.setProgress(10)
         
-        # Raccogli tutti i record dei layer
-        shared_features = {}
-        user_features = {}
-
-        # Carica features del layer condiviso
-        for feature in shared_layer.getFeatures():
-            key_value = str(feature[key_field])
-            shared_features[key_value] = feature
-
-        feedback.setProgress(30)
-
-        # Carica features del layer utente
-        for feature in user_layer.getFeatures():
-            key_value = str(feature[key_field])
-            user_features[key_value] = feature
+        # Campi confrontabili: presenti in entrambi i layer, esclusa la chiave.
+        # Gli itemgetter estraggono in C la tupla dei valori grezzi di una riga
+        shared_fields = shared_layer.fields()
+        user_fields = user_layer.fields()
+        common_fields = self.common_field_indices(shared_fields, user_fields, key_field)
+        common_names = [name for name, _, _ in common_fields]
+        shared_row = self.row_getter([si for _, si, _ in common_fields])
+        user_row = self.row_getter([ui for _, _, ui in common_fields])
+
+        # Normalizzatore scelto una volta per colonna in base al tipo del campo
+        compare_fields = [(name, si, ui, self.value_normalizer(shared_fields.at(si), user_fields.at(ui)))
+                          for name, si, ui in common_fields]
+
+        # Leggi solo la chiave e i campi comuni; la geometria solo se
+        # entrambi i layer ne hanno una (altrimenti non si confronta né si copia)
+        shared_request = QgsFeatureRequest().setSubsetOfAttributes(
+            [key_field] + common_names, shared_fields)
+        user_request = QgsFeatureRequest().setSubsetOfAttributes(
+            [key_field] + common_names, user_fields)
+        if not (shared_layer.isSpatial() and user_layer.isSpatial()):
+            shared_request.setFlags(QgsFeatureRequest.NoGeometry)
+            user_request.setFlags(QgsFeatureRequest.NoGeometry)
+
+        # Chiavi nel loro tipo nativo (testo solo se i tipi differiscono tra i layer);
+        # le chiavi NULL diventano None e corrispondono tra loro in ogni percorso
+        shared_key_idx = shared_fields.indexOf(key_field)
+        user_key_idx = user_fields.indexOf(key_field)
+        same_key_type = shared_fields.at(shared_key_idx).type() == user_fields.at(user_key_idx).type()
+        make_key = self.key_converter(same_key_type)
 
-        feedback.setProgress(50)
-
-        # Trova nuovi record (presenti in user ma non in shared)
-        new_keys = set(user_features.keys()) - set(shared_features.keys())
-        new_features = [user_features[key] for key in new_keys]
-
-        # Trova record modificati
         modified_features = []
-        common_keys = set(shared_features.keys()) & set(user_features.keys())
 
-        feedback.setProgress(70)
-
-        for key in common_keys:
-            shared_feat = shared_features[key]
-            user_feat = user_features[key]
+        def check_modified(shared_feat, user_feat, key):
+            # Confronto rapido: righe grezze e WKB identici -> record invariato,
+            # senza normalizzazione campo per campo né confronto GEOS
+            if (shared_row(shared_feat.attributes()) == user_row(user_feat.attributes()) and
+                    shared_feat.geometry().asWkb() == user_feat.geometry().asWkb()):
+                return
             
-            differences = self.compare_features(shared_feat, user_feat, key_field)
+            differences, changes, new_geometry = self.compare_features(
+                shared_feat, user_feat, compare_fields)
             if differences:
                 modified_features.append({
                     'feature': user_feat,
+                    'fid': shared_feat.id(),
                     'key': key,
-                    'differences': differences
+                    'differences': differences,
+                    'changes': changes,
+                    'geometry': new_geometry
                 })
 
+        shared_source = QgsVectorLayerFeatureSource(shared_layer)
+        user_source = QgsVectorLayerFeatureSource(user_layer)
+        user_count = user_layer.featureCount()
+
+        def compare_pairs(pairs):
+            # pairs: {fid condiviso: (chiave, feature utente)}. Leggi dal layer
+            # condiviso solo questi record, per fid e a blocchi: accesso diretto
+            # per rowid, senza valutare espressioni
+            fids = sorted(pairs)
+            for start in range(0, len(fids), FID_BATCH_SIZE):
+                shared_request.setFilterFids(fids[start:start + FID_BATCH_SIZE])
+                for shared_feat in shared_source.getFeatures(shared_request):
+                    key, user_feat = pairs[shared_feat.id()]
+                    check_modified(shared_feat, user_feat, key)
+
+        # Chiavi e fid del layer condiviso: solo la colonna chiave, senza geometria.
+        # I record completi si leggono poi per fid con compare_pairs
+        key_request = QgsFeatureRequest().setSubsetOfAttributes([key_field], shared_fields)
+        key_request.setFlags(QgsFeatureRequest.NoGeometry)
+
+        # Layer utente grande con chiavi dello stesso tipo: fusione delle chiavi
+        # condivise e dei record utente ordinati per chiave, in memoria restano
+        # solo le differenze e un blocco di coppie da confrontare
+        new_features = None
+        if (user_count < 0 or user_count >= MERGE_JOIN_MIN_USER_FEATURES) and same_key_type:
+            try:
+                new_features = self.merge_differences(
+                    shared_source, key_request, shared_key_idx,
+                    user_source, user_request, user_key_idx,
+                    key_field, make_key, compare_pairs, user_count, feedback)
+            except UnsortedKeysError:
+                feedback.pushInfo("Ordinamento delle chiavi non utilizzabile, confronto in memoria...")
+                modified_features.clear()
+
+        if new_features is None:
+            if 0 <= user_count <= KEY_LOOKUP_MAX_USER_FEATURES:
+                # Pochi record utente: cerca nel layer condiviso solo le loro chiavi
+                # con un unico filtro IN, senza enumerare l'intera colonna chiave.
+                # NULL non corrisponde a nessun valore di IN: si cerca con IS NULL
+                user_features = self.load_keyed(user_source, user_request, user_key_idx, make_key, False)
+                if user_features:
+                    key_column = QgsExpression.quotedColumnRef(key_field)
+                    quoted_keys = ', '.join(QgsExpression.quotedValue(key)
+                                            for key in user_features if key is not None)
+                    conditions = [f"{key_column} IN ({quoted_keys})"] if quoted_keys else []
+                    if None in user_features:
+                        conditions.append(f"{key_column} IS NULL")
+                    key_request.setFilterExpression(' OR '.join(conditions))
+                    shared_fids = self.load_keyed(shared_source, key_request, shared_key_idx, make_key, True)
+                else:
+                    shared_fids = {}
+            else:
+                # Le due letture sono indipendenti: eseguile in parallelo su due thread.
+                # Le feature source si creano qui e si possono iterare in un altro thread
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    shared_future = executor.submit(
+                        self.load_keyed, shared_source, key_request, shared_key_idx, make_key, True)
+                    user_future = executor.submit(
+                        self.load_keyed, user_source, user_request, user_key_idx, make_key, False)
+                    shared_fids = shared_future.result()
+                    user_features = user_future.result()
+
+            feedback.setProgress(50)
+
+            # Trova nuovi record (presenti in user ma non in shared); le viste
+            # delle chiavi supportano le operazioni insiemistiche senza copie
+            new_keys = user_features.keys() - shared_fids.keys()
+            new_features = [user_features[key] for key in new_keys]
+
+            # Trova record modificati
+            common_keys = user_features.keys() & shared_fids.keys()
+
+            feedback.setProgress(70)
+
+            compare_pairs({shared_fids[key]: (key, user_features[key]) for key in common_keys})
+
         feedback.setProgress(90)
 
         # Genera il rapporto
@@ -218,44 +371,208 @@ Crea automaticamente un backup prima dell'aggiornamento.
 
         return new_features, modified_features, report
 
-    def compare_features(self, shared_feat, user_feat, key_field):
+    def merge_differences(self, shared_source, key_request, shared_key_idx,
+                          user_source, user_request, user_key_idx,
+                          key_field, make_key, compare_pairs, user_count, feedback):
+        """
+        Confronta i layer scorrendo in parallelo le chiavi condivise e i record utente
+        ordinati per chiave. Passa a blocchi le coppie con chiave comune a compare_pairs
+        come {fid condiviso: (chiave, feature utente)} e restituisce i nuovi record.
+        Il progresso va dal 10 al 90% in base ai record utente letti (se il conteggio è noto).
+        Solleva UnsortedKeysError se il provider non restituisce le chiavi in ordine
+        """
+        order_by = QgsFeatureRequest.OrderBy([
+            QgsFeatureRequest.OrderByClause(QgsExpression.quotedColumnRef(key_field), True, True)])
+        shared_iter = self.sorted_keyed(
+            shared_source.getFeatures(QgsFeatureRequest(key_request).setOrderBy(order_by)),
+            shared_key_idx, make_key)
+        user_iter = self.sorted_keyed(
+            user_source.getFeatures(QgsFeatureRequest(user_request).setOrderBy(order_by)),
+            user_key_idx, make_key)
+
+        new_features = []
+        pairs = {}
+        progress_step = max(user_count // 80, 1)
+        shared_item = next(shared_iter, None)
+        for count, (user_order, user_key, user_feat) in enumerate(user_iter, 1):
+            try:
+                # Avanza sulle chiavi condivise fino alla chiave utente
+                while shared_item is not None and shared_item[0] < user_order:
+                    shared_item = next(shared_iter, None)
+                matched = shared_item is not None and shared_item[0] == user_order
+            except TypeError:
+                # Chiavi di tipi non confrontabili tra loro
+                raise UnsortedKeysError()
+            
+            if matched:
+                pairs[shared_item[2].id()] = (user_key, user_feat)
+                shared_item = next(shared_iter, None)
+                if len(pairs) >= FID_BATCH_SIZE:
+                    compare_pairs(pairs)
+                    pairs = {}
+            else:
+                new_features.append(user_feat)
+
+            if user_count > 0 and count % progress_step == 0:
+                feedback.setProgress(10 + min(80, 80 * count // user_count))
+
+        # Verifica l'ordinamento anche delle chiavi condivise rimanenti (si legge
+        # solo la colonna chiave): una chiave fuori ordine potrebbe corrispondere
+        # a un record utente
+        for _ in shared_iter:
+            pass
+
+        compare_pairs(pairs)
+        return new_features
+
+    def sorted_keyed(self, features, key_idx, make_key):
+        """
+        Restituisce (ordine, chiave, feature) per feature ordinate per chiave, tenendo
+        l'ultima feature per chiave come nel confronto in memoria.
+        Solleva UnsortedKeysError se le chiavi non sono in ordine crescente
+        """
+        previous = None
+        for feature in features:
+            key = make_key(feature.attribute(key_idx))
+            # Le chiavi NULL vengono prima di tutte le altre, come nell'ordinamento del provider
+            order = (0, 0) if key is None else (1, key)
+            if previous is not None:
+                try:
+                    if order < previous[0]:
+                        raise UnsortedKeysError()
+                    if order != previous[0]:
+                        yield previous
+                except TypeError:
+                    raise UnsortedKeysError()
+            previous = (order, key, feature)
+        if previous is not None:
+            yield previous
+
+    def load_keyed(self, source, request, key_idx, make_key, fid_only):
+        """
+        Legge le feature della sorgente indicizzandole per chiave; con fid_only
+        conserva solo il fid invece dell'intera feature
+        """
+        if fid_only:
+            return {make_key(feature.attribute(key_idx)): feature.id()
+                    for feature in source.getFeatures(request)}
+        return {make_key(feature.attribute(key_idx)): feature
+                for feature in source.getFeatures(request)}
+
+    def key_converter(self, same_key_type):
+        """
+        Restituisce la funzione che converte il valore del campo chiave nella chiave di confronto
+        (None per le chiavi NULL)
+        """
+        # Tipi diversi tra i layer (es. intero e testo): confronto sul testo
+        if not same_key_type:
+            return lambda value: None if self.is_null(value) else str(value)
+        
+        # Stesso tipo: valore nativo; le stringhe (es. UUID) vengono internate
+        # così le chiavi uguali dei due layer sono lo stesso oggetto
+        def make_key(value):
+            if isinstance(value, str):
+                return sys.intern(value)
+            return None if self.is_null(value) else value
+        return make_key
+
+    def is_null(self, value):
+        """
+        Indica se il valore di un attributo è NULL (None o QVariant nullo)
+        """
+        return value is None or (isinstance(value, QVariant) and value.isNull())
+
+    def common_field_indices(self, shared_fields, user_fields, excluded_field=None):
+        """
+        Restituisce (nome, indice condiviso, indice utente) dei campi presenti
+        in entrambi i layer, escluso eventualmente un campo
         """
-        Confronta due feature e restituisce le differenze
+        user_index = {name: i for i, name in enumerate(user_fields.names())}
+        return [(name, i, user_index[name])
+                for i, name in enumerate(shared_fields.names())
+                if name != excluded_field and name in user_index]
+
+    def row_getter(self, indices):
+        """
+        Restituisce una funzione che estrae i valori agli indici dati dalla lista attributi
+        """
+        if not indices:
+            return lambda attributes: ()
+        return itemgetter(*indices)
+
+    def compare_features(self, shared_feat, user_feat, compare_fields):
+        """
+        Confronta due feature e restituisce le differenze, i nuovi valori
+        {indice condiviso: valore} e la nuova geometria (None se invariata).
+        compare_fields: lista di (nome, indice condiviso, indice utente, normalizzatore)
+        dei campi presenti in entrambi i layer, escluso il campo chiave
         """
         differences = []
+        changes = {}
+        new_geometry = None
+        shared_attrs = shared_feat.attributes()
+        user_attrs = user_feat.attributes()
         
-        # Confronta tutti i campi (escludi il campo chiave)
-        for field in shared_feat.fields():
-            field_name = field.name()
-            if field_name == key_field:
-                continue
-                
-            # Controlla se il campo esiste in entrambi i layer
-            if field_name not in user_feat.fields().names():
+        # Confronta i campi comuni per indice, senza ricerche per nome
+        for field_name, shared_idx, user_idx, normalize in compare_fields:
+            shared_value = shared_attrs[shared_idx]
+            user_value = user_attrs[user_idx]
+            
+            # Valori identici: nessuna normalizzazione necessaria
+            if shared_value == user_value:
                 continue
-                
-            shared_value = shared_feat[field_name]
-            user_value = user_feat[field_name]
             
             # Normalizza i valori NULL/vuoti per il confronto
-            shared_normalized = self.normalize_value(shared_value)
-            user_normalized = self.normalize_value(user_value)
+            shared_normalized = normalize(shared_value)
+            user_normalized = normalize(user_value)
             
             # Confronta solo se effettivamente diversi
             if shared_normalized != user_normalized:
                 differences.append(f"{field_name}: '{shared_value}' → '{user_value}'")
+                changes[shared_idx] = user_value
 
-        # Confronta la geometria solo se entrambe esistono e sono valide
+        # Confronta la geometria solo se entrambe esistono: prima i byte WKB,
+        # equals() solo se differiscono (la validità non riguarda il confronto)
         shared_geom = shared_feat.geometry()
         user_geom = user_feat.geometry()
         
-        if (shared_geom and user_geom and 
-            shared_geom.isGeosValid() and user_geom.isGeosValid() and
+        if (shared_geom and user_geom and
+            shared_geom.asWkb() != user_geom.asWkb() and
             not shared_geom.equals(user_geom)):
             differences.append("geometry: modificata")
+            new_geometry = user_geom
 
-        return differences
+        return differences, changes, new_geometry
     
+    def value_normalizer(self, shared_field, user_field):
+        """
+        Sceglie la funzione di normalizzazione adatta al tipo della colonna
+        """
+        if shared_field.type() == user_field.type() == QVariant.String:
+            return self.normalize_string
+        if shared_field.isNumeric() and user_field.isNumeric():
+            return self.normalize_number
+        return self.normalize_value
+
+    def normalize_string(self, value):
+        """
+        Normalizza i valori di un campo testo; i valori non stringa (NULL) usano normalize_value
+        """
+        if value.__class__ is str:
+            # Stringa vuota o "NULL" -> None, altrimenti senza spazi bianchi
+            if value == '' or value.upper() == 'NULL':
+                return None
+            return value.strip()
+        return self.normalize_value(value)
+
+    def normalize_number(self, value):
+        """
+        Normalizza i valori di un campo numerico (NaN -> None); gli altri valori (NULL) usano normalize_value
+        """
+        if value.__class__ is int or value.__class__ is float:
+            return None if value != value else value
+        return self.normalize_value(value)
+
     def normalize_value(self, value):
         """
         Normalizza i valori per il confronto gestendo NULL, None, stringhe vuote, ecc.
@@ -287,36 +604,40 @@ Crea automaticamente un backup prima dell'aggiornamento.
         """
         Genera il rapporto delle differenze
         """
-        report = []
-        report.append("=== RAPPORTO AGGIORNAMENTO GEOPACKAGE ===")
-        report.append(f"Data/Ora: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        report.append(f"Campo chiave utilizzato: {key_field}")
-        report.append("")
+        n_new = len(new_features)
+        n_mod = len(modified_features)
+        
+        report = [
+            "=== RAPPORTO AGGIORNAMENTO GEOPACKAGE ===",
+            f"Data/Ora: {time.strftime('%Y-%m-%d %H:%M:%S')}",
+            f"Campo chiave utilizzato: {key_field}",
+            "",
+        ]
 
         # Nuovi record
-        if new_features:
-            report.append(f"🆕 NUOVI RECORD DA INSERIRE: {len(new_features)}")
-            for feature in new_features[:10]:  # Mostra solo i primi 10
-                key_value = feature[key_field]
-                report.append(f"  - {key_field}: {key_value}")
-            if len(new_features) > 10:
-                report.append(f"  ... e altri {len(new_features) - 10} record")
+        if n_new:
+            report.append(f"🆕 NUOVI RECORD DA INSERIRE: {n_new}")
+            # Mostra solo i primi 10
+            report.extend(f"  - {key_field}: {feature[key_field]}" for feature in new_features[:10])
+            if n_new > 10:
+                report.append(f"  ... e altri {n_new - 10} record")
             report.append("")
 
         # Record modificati
-        if modified_features:
-            report.append(f"✏️ RECORD MODIFICATI: {len(modified_features)}")
+        if n_mod:
+            report.append(f"✏️ RECORD MODIFICATI: {n_mod}")
             for mod_feat in modified_features[:10]:  # Mostra solo i primi 10
+                differences = mod_feat['differences']
                 report.append(f"  - {key_field}: {mod_feat['key']}")
-                for diff in mod_feat['differences'][:5]:  # Mostra solo le prime 5 differenze
-                    report.append(f"    {diff}")
-                if len(mod_feat['differences']) > 5:
-                    report.append(f"    ... e altre {len(mod_feat['differences']) - 5} differenze")
+                # Mostra solo le prime 5 differenze
+                report.extend(f"    {diff}" for diff in differences[:5])
+                if len(differences) > 5:
+                    report.append(f"    ... e altre {len(differences) - 5} differenze")
                 report.append("")
-            if len(modified_features) > 10:
-                report.append(f"  ... e altri {len(modified_features) - 10} record modificati")
+            if n_mod > 10:
+                report.append(f"  ... e altri {n_mod - 10} record modificati")
 
-        if not new_features and not modified_features:
+        if not n_new and not n_mod:
             report.append("✅ NESSUNA DIFFERENZA TROVATA")
             report.append("I layer sono già sincronizzati.")
 
@@ -324,7 +645,8 @@ Crea automaticamente un backup prima dell'aggiornamento.
 
     def update_with_qgis_api_only(self, shared_layer, new_features, modified_features, key_field, feedback):
         """
-        Aggiorna usando SOLO l'API di QGIS - niente SQL
+        Aggiorna scrivendo i dati con il provider di QGIS; per scritture massive
+        l'indice spaziale viene rimosso e ricreato con le funzioni SQL di GDAL (osgeo.ogr)
         """
         try:
             # Crea backup del file
@@ -334,104 +656,360 @@ Crea automaticamente un backup prima dell'aggiornamento.
             else:
                 file_path = source
 
+            backup_path = None
             if os.path.exists(file_path) and file_path.endswith('.gpkg'):
                 backup_path = f"{file_path}.backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-                shutil.copy2(file_path, backup_path)
-                feedback.pushInfo(f"Backup creato: {backup_path}")
+                copy_method = self.create_backup(file_path, backup_path)
+                feedback.pushInfo(f"Backup creato ({copy_method}): {backup_path}")
 
-            # Assicurati che non sia in editing
+            # Assicurati che non sia in editing: le scritture vanno
+            # direttamente al provider, senza passare dal buffer di editing
             if shared_layer.isEditable():
                 shared_layer.commitChanges()
 
-            # Inizia editing
-            feedback.pushInfo("Iniziando modalità editing...")
-            if not shared_layer.startEditing():
-                return "❌ Impossibile iniziare editing del layer"
-
-            report_lines = []
+            provider = shared_layer.dataProvider()
+            provider.clearErrors()
 
+            spatial_index = None
+            index_error = None
             try:
-                # Aggiungi nuovi record
-                if new_features:
-                    feedback.pushInfo(f"Aggiunta di {len(new_features)} nuovi record...")
-                    
-                    for feature in new_features:
-                        # Crea nuova feature compatibile
-                        new_feat = QgsFeature(shared_layer.fields())
-                        
-                        # Copia solo i campi che esistono in entrambi i layer
-                        for field in shared_layer.fields():
-                            field_name = field.name()
-                            if field_name in feature.fields().names():
-                                new_feat[field_name] = feature[field_name]
-                        
-                        # Copia geometria
-                        if feature.geometry():
-                            new_feat.setGeometry(feature.geometry())
-                        
-                        # Aggiungi al layer
-                        if not shared_layer.addFeature(new_feat):
-                            feedback.pushInfo(f"⚠️ Problemi aggiunta record {feature[key_field]}")
-
-                    report_lines.append(f"✅ Aggiunti {len(new_features)} nuovi record")
-
-                # Aggiorna record esistenti
-                if modified_features:
-                    feedback.pushInfo(f"Aggiornamento di {len(modified_features)} record...")
-                    
-                    for mod_feat_data in modified_features:
-                        key_value = mod_feat_data['key']
-                        new_feature = mod_feat_data['feature']
-                        
-                        # Trova il record esistente
-                        request = QgsFeatureRequest().setFilterExpression(f'"{key_field}" = \'{key_value}\'')
-                        existing_features = list(shared_layer.getFeatures(request))
-                        
-                        if existing_features:
-                            existing_feat = existing_features[0]
-                            fid = existing_feat.id()
-                            
-                            # Aggiorna campo per campo
-                            for i, field in enumerate(shared_layer.fields()):
-                                field_name = field.name()
-                                if field_name == key_field:
-                                    continue  # Non modificare la chiave
-                                
-                                if field_name in new_feature.fields().names():
-                                    new_value = new_feature[field_name]
-                                    shared_layer.changeAttributeValue(fid, i, new_value)
-                            
-                            # Aggiorna geometria
-                            if new_feature.geometry():
-                                shared_layer.changeGeometry(fid, new_feature.geometry())
-
-                    report_lines.append(f"✅ Aggiornati {len(modified_features)} record")
-
-                # Commit delle modifiche
-                feedback.pushInfo("Salvando modifiche...")
-                if shared_layer.commitChanges():
-                    report_lines.append("🎉 AGGIORNAMENTO COMPLETATO CON SUCCESSO!")
-                    
-                    # Ricarica il layer
-                    shared_layer.reload()
-                    
-                    return "\n".join(report_lines)
-                else:
-                    # Errori durante il commit
-                    errors = shared_layer.commitErrors()
-                    error_msg = f"❌ Errori durante il salvataggio: {'; '.join(errors)}"
-                    feedback.pushInfo(error_msg)
-                    shared_layer.rollBack()
-                    return error_msg
+                # Per scritture massive rispetto alla dimensione del layer rimuovi
+                # l'indice spaziale: altrimenti i trigger RTree lo aggiornano record per record.
+                # Contano solo inserimenti e geometrie modificate: le modifiche ai
+                # soli attributi non attivano i trigger dell'indice
+                geometry_writes = len(new_features) + sum(
+                    1 for modified in modified_features if modified['geometry'] is not None)
+                if (shared_layer.isSpatial() and file_path.endswith('.gpkg') and
+                        self.rebuild_spatial_index_worthwhile(
+                            geometry_writes, shared_layer.featureCount())):
+                    uri_parts = QgsProviderRegistry.instance().decodeUri(shared_layer.providerType(), source)
+                    spatial_index = self.disable_spatial_index(
+                        file_path, uri_parts.get('layerName'), uri_parts.get('layerId'))
+                    if spatial_index:
+                        feedback.pushInfo("Indice spaziale disattivato durante l'aggiornamento")
+
+                result = self.apply_changes(
+                    shared_layer, provider, new_features, modified_features, backup_path, feedback)
 
             except Exception as e:
-                # Rollback in caso di errore
-                shared_layer.rollBack()
-                return f"❌ Errore durante l'aggiornamento: {str(e)}"
+                result = f"❌ Errore durante l'aggiornamento: {str(e)}"
+
+            finally:
+                # Ricostruisci l'indice spaziale in un'unica passata; un errore
+                # non deve impedire di ricaricare il layer
+                if spatial_index:
+                    feedback.pushInfo("Ricostruzione indice spaziale...")
+                    try:
+                        restored = self.restore_spatial_index(file_path, *spatial_index)
+                    except Exception:
+                        restored = False
+                    if not restored:
+                        table, geom_column = spatial_index
+                        index_error = (f"⚠️ Impossibile ricostruire l'indice spaziale di {table}.{geom_column}: "
+                                       f"ricrearlo manualmente (es. SELECT CreateSpatialIndex('{table}', '{geom_column}'))")
+                        feedback.reportError(index_error)
+                
+                # Ricarica il layer
+                shared_layer.reload()
+
+            if index_error:
+                result += "\n" + index_error
+            return result
 
         except Exception as e:
             return f"❌ Errore generale: {str(e)}"
 
+    def apply_changes(self, shared_layer, provider, new_features, modified_features, backup_path, feedback):
+        """
+        Scrive sul provider i nuovi record e le modifiche in un'unica transazione e restituisce il rapporto.
+        Se la transazione non è disponibile ogni chiamata al provider viene salvata da sola
+        """
+        shared_fields = shared_layer.fields()
+        provider_index = self.provider_field_indices(shared_fields)
+        report_lines = []
+
+        # Nuovi record compatibili con i campi del provider
+        features_to_add = []
+        if new_features:
+            # Campi che esistono in entrambi i layer, calcolati una volta sola
+            # e riportati agli indici dei campi del provider
+            copy_fields = [(provider_index[shared_idx], user_idx)
+                           for _, shared_idx, user_idx
+                           in self.common_field_indices(shared_fields, new_features[0].fields())
+                           if shared_idx in provider_index]
+            provider_fields = provider.fields()
+
+            for feature in new_features:
+                # Crea nuova feature compatibile con i campi del provider
+                new_feat = QgsFeature(provider_fields)
+
+                # Copia solo i campi che esistono in entrambi i layer
+                attrs = feature.attributes()
+                for provider_idx, user_idx in copy_fields:
+                    new_feat.setAttribute(provider_idx, attrs[user_idx])
+
+                # Copia geometria
+                if feature.geometry():
+                    new_feat.setGeometry(feature.geometry())
+
+                features_to_add.append(new_feat)
+
+        # Mappe {fid: {indice_campo: valore}} e {fid: geometria} con
+        # i soli campi e geometrie risultati diversi nell'analisi.
+        # Gli indici del layer vanno convertiti in quelli del provider
+        attr_changes = {}
+        geom_changes = {}
+        for mod_feat_data in modified_features:
+            # Il fid del record condiviso è già noto dall'analisi:
+            # nessuna ricerca per espressione sul layer
+            fid = mod_feat_data['fid']
+            changes = {provider_index[i]: value
+                       for i, value in mod_feat_data['changes'].items()
+                       if i in provider_index}
+            if changes:
+                attr_changes[fid] = changes
+            if mod_feat_data['geometry'] is not None:
+                geom_changes[fid] = mod_feat_data['geometry']
+
+        # Una sola transazione sulla connessione del provider per tutte le
+        # scritture: un errore annulla anche quelle già eseguite. Con il backup
+        # disponibile la connessione usa i PRAGMA per scrittura massiva
+        bulk_write = backup_path is not None
+        transaction = self.begin_transaction(shared_layer, bulk_write, feedback)
+        committed = False
+        try:
+            if features_to_add:
+                feedback.pushInfo(f"Aggiunta di {len(new_features)} nuovi record...")
+
+                # Inserimento in blocco: una sola chiamata al provider
+                added, _ = provider.addFeatures(features_to_add, QgsFeatureSink.FastInsert)
+                if not added:
+                    return self.write_error("l'aggiunta dei record", provider.errors(),
+                                            transaction, report_lines, backup_path, feedback)
+
+                report_lines.append(f"✅ Aggiunti {len(new_features)} nuovi record")
+
+            # Aggiorna i record esistenti direttamente sul provider:
+            # una sola chiamata per gli attributi e una per le geometrie,
+            # invece di una modifica per campo
+            if modified_features:
+                feedback.pushInfo(f"Aggiornamento di {len(modified_features)} record...")
+
+                if attr_changes and not provider.changeAttributeValues(attr_changes):
+                    return self.write_error("l'aggiornamento degli attributi", provider.errors(),
+                                            transaction, report_lines, backup_path, feedback)
+
+                if geom_changes and not provider.changeGeometryValues(geom_changes):
+                    return self.write_error("l'aggiornamento delle geometrie", provider.errors(),
+                                            transaction, report_lines, backup_path, feedback)
+
+                report_lines.append(f"✅ Aggiornati {len(modified_features)} record")
+
+            if transaction is not None:
+                feedback.pushInfo("Salvando modifiche...")
+                committed, error = transaction.commit()
+                if not committed:
+                    return self.write_error("il salvataggio", [error],
+                                            transaction, report_lines, backup_path, feedback)
+
+        except Exception as e:
+            return self.write_error("l'aggiornamento", [str(e)],
+                                    transaction, report_lines, backup_path, feedback)
+
+        finally:
+            # Annulla la transazione se non è stata salvata
+            # e ripristina le impostazioni della connessione
+            if transaction is not None:
+                if not committed:
+                    transaction.rollback()
+                if bulk_write:
+                    self.set_pragmas(transaction, self.default_pragmas())
+
+        report_lines.append("🎉 AGGIORNAMENTO COMPLETATO CON SUCCESSO!")
+
+        return "\n".join(report_lines)
+
+    def begin_transaction(self, shared_layer, bulk_write, feedback):
+        """
+        Apre una transazione sulla connessione del provider del layer (None se non disponibile).
+        Con bulk_write imposta prima i PRAGMA per scrittura massiva sulla stessa connessione
+        """
+        transaction = QgsTransaction.create({shared_layer})
+        if transaction is None:
+            feedback.pushInfo("Transazione non disponibile: ogni scrittura viene salvata separatamente")
+            return None
+
+        # synchronous non si può cambiare a transazione aperta: va impostato prima di BEGIN
+        if bulk_write:
+            failed = self.set_pragmas(transaction, BULK_WRITE_PRAGMAS)
+            if failed:
+                feedback.pushInfo(f"PRAGMA per scrittura massiva non applicati: {'; '.join(failed)}")
+            else:
+                feedback.pushInfo("PRAGMA per scrittura massiva applicati alla connessione del provider")
+
+        begun, error = transaction.begin()
+        if not begun:
+            if bulk_write:
+                self.set_pragmas(transaction, self.default_pragmas())
+            feedback.pushInfo(f"Transazione non disponibile ({error}): ogni scrittura viene salvata separatamente")
+            return None
+
+        # Il provider deve scrivere attraverso la transazione, altrimenti non è atomica
+        if shared_layer.dataProvider().transaction() is None:
+            transaction.rollback()
+            if bulk_write:
+                self.set_pragmas(transaction, self.default_pragmas())
+            feedback.pushInfo("Il provider non usa la transazione: ogni scrittura viene salvata separatamente")
+            return None
+
+        return transaction
+
+    def set_pragmas(self, transaction, pragmas):
+        """
+        Esegue i PRAGMA {nome: valore} sulla connessione della transazione
+        e restituisce gli errori di quelli non applicati
+        """
+        failed = []
+        for name, value in pragmas.items():
+            applied, error = transaction.executeSql(f"PRAGMA {name} = {value}")
+            if not applied:
+                failed.append(f"{name}: {error}")
+        return failed
+
+    def default_pragmas(self):
+        """
+        Restituisce i valori con cui GDAL apre le connessioni SQLite: quelli delle
+        opzioni OGR_SQLITE_SYNCHRONOUS e OGR_SQLITE_CACHE (MB) o i predefiniti di SQLite
+        """
+        cache_mb = gdal.GetConfigOption('OGR_SQLITE_CACHE')
+        return {
+            'synchronous': gdal.GetConfigOption('OGR_SQLITE_SYNCHRONOUS', 'FULL'),
+            'cache_size': f"-{int(cache_mb) * 1024}" if cache_mb and cache_mb.isdigit() else '-2000',
+            'temp_store': 'DEFAULT',
+        }
+
+    def write_error(self, step, errors, transaction, completed, backup_path, feedback):
+        """
+        Restituisce il rapporto di una scrittura fallita: con la transazione non resta salvato nulla,
+        altrimenti elenca i passi già salvati nel file e il backup da cui ripristinarlo
+        """
+        lines = [f"❌ Errori durante {step}: {'; '.join(errors)}"]
+        if transaction is not None:
+            lines.append("Nessuna modifica salvata: la transazione viene annullata")
+        elif completed:
+            lines.append("Passi già salvati nel file:")
+            lines.extend(f"  {line}" for line in completed)
+            if backup_path:
+                lines.append(f"Per annullarli ripristinare il backup: {backup_path}")
+
+        error_msg = "\n".join(lines)
+        feedback.pushInfo(error_msg)
+        return error_msg
+
+    def rebuild_spatial_index_worthwhile(self, write_count, feature_count):
+        """
+        Indica se conviene rimuovere e ricostruire l'indice spaziale per il numero di geometrie scritte
+        """
+        if feature_count < 0 or write_count < SPATIAL_INDEX_REBUILD_MIN_WRITES:
+            return False
+        return write_count >= feature_count * SPATIAL_INDEX_REBUILD_RATIO
+
+    def provider_field_indices(self, fields):
+        """
+        Restituisce {indice nel layer: indice nel provider} dei soli campi del provider
+        (esclusi i campi di join, virtuali ed espressioni)
+        """
+        return {i: fields.fieldOriginIndex(i)
+                for i in range(fields.count())
+                if fields.fieldOrigin(i) == QgsFields.OriginProvider}
+
+    def create_backup(self, file_path, backup_path):
+        """
+        Copia il file nel backup con il metodo più veloce disponibile e restituisce quello usato
+        """
+        # Copy-on-write (btrfs, xfs, apfs): nessun byte copiato
+        if reflink is not None:
+            try:
+                reflink.reflink(file_path, backup_path)
+                shutil.copystat(file_path, backup_path)
+                return 'reflink'
+            except Exception:
+                pass
+
+        # Copia nel kernel senza passare dallo spazio utente (Linux)
+        if hasattr(os, 'copy_file_range'):
+            try:
+                with open(file_path, 'rb') as src, open(backup_path, 'wb') as dst:
+                    remaining = os.fstat(src.fileno()).st_size
+                    while remaining > 0:
+                        copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                        if copied == 0:
+                            break
+                        remaining -= copied
+                if remaining == 0:
+                    shutil.copystat(file_path, backup_path)
+                    return 'copy_file_range'
+            except OSError:
+                pass
+
+        shutil.copy2(file_path, backup_path)
+        return 'shutil.copy2'
+
+    def disable_spatial_index(self, file_path, layer_name, layer_id=None):
+        """
+        Rimuove l'indice spaziale RTree (tabella e trigger) del layer.
+        Restituisce (tabella, colonna geometria) se l'indice è stato rimosso, altrimenti None
+        """
+        dataset = ogr.Open(file_path, 1)
+        if dataset is None:
+            return None
+        if layer_name:
+            layer = dataset.GetLayerByName(layer_name)
+        elif layer_id is not None:
+            layer = dataset.GetLayer(int(layer_id))
+        else:
+            layer = dataset.GetLayer(0)
+        if layer is None or not layer.GetGeometryColumn():
+            return None
+
+        table = layer.GetName()
+        geom_column = layer.GetGeometryColumn()
+        args = f"{self.sql_literal(table)}, {self.sql_literal(geom_column)}"
+
+        if not self.execute_scalar(dataset, f"SELECT HasSpatialIndex({args})"):
+            return None
+        if not self.execute_scalar(dataset, f"SELECT DisableSpatialIndex({args})"):
+            return None
+        return table, geom_column
+
+    def restore_spatial_index(self, file_path, table, geom_column):
+        """
+        Ricrea l'indice spaziale RTree del layer popolandolo in blocco
+        """
+        dataset = ogr.Open(file_path, 1)
+        if dataset is None:
+            return False
+        args = f"{self.sql_literal(table)}, {self.sql_literal(geom_column)}"
+        return bool(self.execute_scalar(dataset, f"SELECT CreateSpatialIndex({args})"))
+
+    def execute_scalar(self, dataset, sql):
+        """
+        Esegue una query GDAL e restituisce il primo valore del risultato (None se fallisce)
+        """
+        result = dataset.ExecuteSQL(sql)
+        if result is None:
+            return None
+        feature = result.GetNextFeature()
+        value = feature.GetField(0) if feature is not None else None
+        dataset.ReleaseResultSet(result)
+        return value
+
+    def sql_literal(self, value):
+        """
+        Quota una stringa come letterale SQL
+        """
+        return "'" + value.replace("'", "''") + "'"
+
 
 def classFactory(iface):
     """